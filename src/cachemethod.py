@@ -1,8 +1,10 @@
-import time
+import random
 import weakref
-from threading import Lock
-from functools import wraps
-from collections import namedtuple
+import itertools
+from array import array
+from threading import Event, Lock, RLock, get_ident
+from functools import partial, wraps
+from collections import namedtuple, OrderedDict
 from typing import Callable, TypeVar
 
 
@@ -10,173 +12,407 @@ __all__ = ("lru_cachemethod",)
 
 _RT = TypeVar("_RT")
 
-_CACHE_SEED_ATTR = "__cache_seed__"
-
 _CacheInfo = namedtuple("CacheInfo", ("misses", "hits", "maxsize", "full"))
-_PREV, _NEXT, _KEY, _RESULT = 0, 1, 2, 3
 _LRU_DEFAULT_MAXSIZE = 128
 
+# number of (lock, cache) shards per wrapper, must stay a power of two
+# so keys can be mapped to a shard with `hashvalue & (_SHARDS - 1)`
+_SHARDS = 16
+
+# cached results may legitimately be `None` so lookups
+# need a sentinel that can never be a stored value
+_sentinel = object()
+
+# separates positional arguments from keyword items inside the key
+# tuple so f(1, x=2) and f(1, ("x", 2)) can't build the same key
+_kwd_mark = (object(),)
+
+
+class _HashedSeq(list):
+    """
+    tuple-like cache key that hashes its items once on creation
+    (same trick as functools), the dict probe then reuses the
+    precomputed value instead of rehashing the whole tuple
+    """
+
+    __slots__ = ("hashvalue",)
+
+    def __init__(self, tup, hash=hash):
+        self[:] = tup
+        self.hashvalue = hash(tup)
 
-def _hash_args_kwargs(args, kwargs) -> int:
-    return hash(args) + sum(map(hash, kwargs.items()))
+    def __hash__(self):
+        return self.hashvalue
 
 
-def _make_cache_key_seed(seed, args, kwargs) -> int:
+def _make_cache_key_seed(seed, args, kwargs) -> _HashedSeq:
     """generates a cache key based on given seed, args and kwargs"""
-    return seed + _hash_args_kwargs(args, kwargs)
+    # the vast majority of cached calls are positional only, skip the
+    # kwargs handling entirely for them, sorting the kwarg items
+    # collapses f(a=1, b=2) and f(b=2, a=1) into one entry
+    if not kwargs:
+        return _HashedSeq((seed,) + args)
+    return _HashedSeq((seed,) + args + _kwd_mark + tuple(sorted(kwargs.items())))
 
 
-def _make_cache_key_weakref(__weak_self__, args, kwargs):
+def _make_cache_key_weakref(__weak_self__, args, kwargs) -> _HashedSeq:
     """
     stored `self` weakref in the tuple key, making the weakref instance never die
     but the pointed instance is free to die
     """
-    return (__weak_self__, _hash_args_kwargs(args, kwargs))
+    if not kwargs:
+        return _HashedSeq((__weak_self__,) + args)
+    return _HashedSeq((__weak_self__,) + args + _kwd_mark + tuple(sorted(kwargs.items())))
 
 
-def _make_seed(used_seeds: set[int]) -> int:
-    """generate seed that cannot be found in the given `used_seeds` set"""
-    while (seed := round(time.time() * 1000)) in used_seeds:
-        continue
-    return seed
+# random high bits keep seeds from colliding across processes, the
+# counter low bits guarantee uniqueness inside the process
+_seed_counter = itertools.count(random.getrandbits(32) << 32)
 
 
-def _marshall_seed(__self__, cache_lock: Lock, used_seeds_set: set):
-    with cache_lock:
-        # get the seed from the instance, if no
-        # seed found, generate and set it
-        if not hasattr(__self__, _CACHE_SEED_ATTR):
-            seed = _make_seed(used_seeds_set)
-            used_seeds_set.add(seed)
-            setattr(__self__, _CACHE_SEED_ATTR, seed)
-            return seed
-        else:
-            return getattr(__self__, _CACHE_SEED_ATTR)
+def _make_seed() -> int:
+    """generate a seed unique for the lifetime of the process"""
+    return next(_seed_counter)
 
 
-def _marshall_weakref(__self__, cache_lock: Lock):
-    return weakref.ref(__self__)
+def _finalize_seed_instance(instance_seeds: dict, instance_id: int, seed, evict):
+    """
+    runs when a seeded instance dies, forgets its seed (so a new
+    instance allocated on the same address won't inherit it) and
+    evicts every cache entry that was keyed on it
+    """
+    instance_seeds.pop(instance_id, None)
+    evict(seed)
+
+
+def _marshall_seed(__self__, cache_lock: Lock, instance_seeds: dict, evict):
+    # EAFP hit path, a plain subscript is cheaper than .get plus a
+    # sentinel compare and only first-call-per-instance pays for the
+    # exception, the lock is only taken for that first call as well
+    try:
+        return instance_seeds[id(__self__)]
+    except KeyError:
+        with cache_lock:
+            # re-check under the lock, another thread may have minted
+            # a seed for this instance while we were acquiring it
+            seed = instance_seeds.get(id(__self__))
+            if seed is None:
+                seed = _make_seed()
+                instance_seeds[id(__self__)] = seed
+                try:
+                    weakref.finalize(
+                        __self__, _finalize_seed_instance, instance_seeds, id(__self__), seed, evict
+                    )
+                except TypeError:
+                    # without a weak reference there is no way to know
+                    # when the instance dies, a new instance allocated
+                    # on the recycled address would silently inherit
+                    # this seed and hit the dead instance's entries,
+                    # so fail loudly instead of caching stale data
+                    del instance_seeds[id(__self__)]
+                    raise TypeError(
+                        f"cannot cache methods of {type(__self__).__name__!r} instances, "
+                        "the class must support weak references"
+                    ) from None
+    return seed
 
 
-def _base_seed():
-    used_seeds_set = set()
+def _finalize_weakref_instance(instance_refs: dict, instance_id: int, evict, dead_ref):
+    """
+    runs as the ref callback when a marshalled instance dies, forgets
+    the cached ref and evicts every cache entry that was keyed on it
+    """
+    instance_refs.pop(instance_id, None)
+    evict(dead_ref)
+
+
+def _marshall_weakref(__self__, cache_lock: Lock, instance_refs: dict, evict):
+    # one callback-ref per instance cached by id, hits reuse it
+    # instead of allocating a fresh weakref on every call and death
+    # fires exactly one eviction pass, dead refs compare by identity
+    # so the eviction only ever matches this instance's keys
+    try:
+        return instance_refs[id(__self__)]
+    except KeyError:
+        with cache_lock:
+            # re-check under the lock, another thread may have created
+            # the ref for this instance while we were acquiring it
+            ref = instance_refs.get(id(__self__))
+            if ref is None:
+                ref = weakref.ref(
+                    __self__,
+                    partial(_finalize_weakref_instance, instance_refs, id(__self__), evict),
+                )
+                instance_refs[id(__self__)] = ref
+    return ref
+
+
+def _base_seed(evict):
+    instance_seeds: dict[int, int] = {}
     return (
         lambda *args, **kwargs: _marshall_seed(
-            *args, **kwargs, used_seeds_set=used_seeds_set
+            *args, **kwargs, instance_seeds=instance_seeds, evict=evict
         ),
         _make_cache_key_seed,
     )
 
 
-def _base_weakref():
-    return (_marshall_weakref, _make_cache_key_weakref)
+def _base_weakref(evict):
+    instance_refs: dict[int, weakref.ref] = {}
+    return (
+        lambda *args, **kwargs: _marshall_weakref(
+            *args, **kwargs, instance_refs=instance_refs, evict=evict
+        ),
+        _make_cache_key_weakref,
+    )
 
 
 def _lru_cachemthod_wrapper(
     func: Callable[..., _RT],
-    maxsize: int,
-    base: Callable[[], tuple[Callable, Callable]],
+    maxsize: int | None,
+    base: Callable[[Callable], tuple[Callable, Callable]],
 ) -> Callable[..., _RT]:
-    misses = hits = 0
-    lock = Lock()
-    full = False
-    cache = {}
+    # threads touching different shards never contend, each shard
+    # has its own lock, its own `OrderedDict` (move_to_end and
+    # popitem splice entries in a single C call instead of the python
+    # level prev/next pointer juggling a hand rolled list needs) and
+    # its own [hits, misses] counters, `get` and `move_to_end` are
+    # bound once per shard so the hit path skips the attribute lookups
+    # (same trick functools uses with its local cache_get)
+    # the inflight dict holds an event per key currently being
+    # computed so concurrent misses on the same key wait for the
+    # first caller instead of invoking `func` again, unbounded caches
+    # never evict or splice so a plain dict is enough for them
+    # a wrapper never gets more shards than maxsize, otherwise the
+    # per-shard bound would round up and total capacity could exceed
+    # what the caller asked for, the count stays a power of two so
+    # keys still map to shards with a mask
+    if maxsize is None:
+        shard_count = _SHARDS
+    else:
+        shard_count = 1 << (min(_SHARDS, max(1, maxsize)).bit_length() - 1)
+    shard_mask = shard_count - 1
+
+    shards = []
+    for _ in range(shard_count):
+        shard_cache = {} if maxsize is None else OrderedDict()
+        shards.append(
+            (
+                # reentrant because dropping a cached value can run a
+                # dead instance's finalizer, which evicts through the
+                # same shard locks on the same thread
+                RLock(),
+                shard_cache,
+                # [hits, misses] as a machine-int array, index stores
+                # on it use the specialized subscript opcodes and skip
+                # boxing the counter back into a list slot
+                array("q", [0, 0]),
+                shard_cache.get,
+                getattr(shard_cache, "move_to_end", None),
+                {},
+                # marshalled-self -> set of its keys in this shard,
+                # lets per-instance eviction touch only that
+                # instance's entries instead of scanning the cache
+                {},
+            )
+        )
+    shards = tuple(shards)
+    shard_maxsize = None if maxsize is None else max(1, maxsize // shard_count)
+
+    # marshalling (seed creation) is rare, it gets a dedicated lock
+    # so shard locks only ever guard their own cache
+    marshall_lock = Lock()
+
+    def _evict_marshalled(marshalled_self) -> None:
+        """
+        drops every cache entry that belongs to the given marshalled
+        instance (seed or weakref) in O(its entries), the per-shard
+        index maps the marshalled instance straight to its keys
+        """
+        # evicted keys and values are kept alive here until every
+        # lock is released, dropping the last reference to a cached
+        # value can kill another instance and chain into its own
+        # eviction pass over the same locks
+        graveyard = []
+        for lock, cache, _, _, _, _, owner_keys in shards:
+            with lock:
+                keys = owner_keys.pop(marshalled_self, ())
+                for key in keys:
+                    graveyard.append(cache.pop(key, None))
+                graveyard.append(keys)
+        del graveyard
 
     # base function should return 2 functions, first is "marshall" function (i don't have a better name)
     # which takes `self` and the lock, and should return a marshalled self that we can
     # pass to `make_key` which is the 2 function returned by `base` that should
-    # return to us a valid hash key
-    marshall_self, make_key = base()
-
-    # root is the root of the circular queue, values
-    # matching the _PREV, _NEXT, _KEY, _RESULT consts
-    root = []
-    root[:] = [root, root, None, None]
-
-    @wraps(func)
-    def cache_wrapper(__self__, *args, **kwargs) -> _RT:
-        nonlocal misses, hits, full, root
-
-        marshalled_self = marshall_self(__self__, lock)
-        key = make_key(marshalled_self, args, kwargs)
-
-        with lock:
-            node = cache.get(key)
-            if node is not None:
-                prev, next_, key, result = node
-
-                # pop the current node from its position
-                prev[_NEXT] = next_
-                next_[_PREV] = prev
-
-                # push the node after the
-                # last node in the list, making the current node last
-                last = root[_PREV]
-                last[_NEXT] = root[_PREV] = node
-                node[_PREV] = last
-                node[_NEXT] = root
-                hits += 1
-                return result
-            misses += 1
-
-        result = func(__self__, *args, **kwargs)
-
-        with lock:
-            if key in cache:
-                # based on python stdlib code this can happen
-                # if the same key was added when the lock was released
-                pass
-            elif full:
-                # use the oldest node which is the root
-                # to store the new key and result
-                node = root
-                node[_KEY] = key
-                node[_RESULT] = result
-
-                # mark the next node as current root
-                # marking it also the oldest one
-                root = node[_NEXT]
-                oldkey = root[_KEY]
-
-                # deleting the root, key and result because
-                # the root shouldn't containt data except being
-                # the head of the queue marking the oldest and the newest items
-                root[_KEY] = root[_RESULT] = None
-                del cache[oldkey]
-            else:
-                last = root[_PREV]
-                node = [last, root, key, result]
-                last[_NEXT] = root[_PREV] = cache[key] = node
-                full = len(cache) >= maxsize
-        cache[key] = node
-        return result
+    # return to us a valid hash key, `base` receives the evict callback
+    # so dead instances can clean their entries out of the cache
+    marshall_self, make_key = base(_evict_marshalled)
+
+    if maxsize is None:
+
+        @wraps(func)
+        def cache_wrapper(__self__, *args, **kwargs) -> _RT:
+            # unbounded variant specialized at decoration time, plain
+            # memoization with no recency bookkeeping so calls don't
+            # pay for eviction branches that can never run
+            marshalled_self = marshall_self(__self__, marshall_lock)
+            key = make_key(marshalled_self, args, kwargs)
+            lock, cache, counters, cache_get, _, inflight, owner_keys = shards[
+                key.hashvalue & shard_mask
+            ]
+
+            with lock:
+                result = cache_get(key, _sentinel)
+                if result is not _sentinel:
+                    counters[0] += 1
+                    return result
+                counters[1] += 1
+                event = leading_event = None
+                inflight_entry = inflight.get(key)
+                if inflight_entry is None:
+                    leading_event = Event()
+                    inflight[key] = (get_ident(), leading_event)
+                elif inflight_entry[0] != get_ident():
+                    event = inflight_entry[1]
+                # else: reentrant call from the thread already
+                # computing this key, waiting on itself would
+                # deadlock so fall through and recompute instead
+
+            if event is not None:
+                event.wait()
+                with lock:
+                    result = cache_get(key, _sentinel)
+                    if result is not _sentinel:
+                        return result
+
+            try:
+                result = func(__self__, *args, **kwargs)
+                with lock:
+                    if key not in cache:
+                        cache[key] = result
+                        owner_keys.setdefault(key[0], set()).add(key)
+            finally:
+                if leading_event is not None:
+                    with lock:
+                        inflight.pop(key, None)
+                    leading_event.set()
+            return result
+
+    else:
+
+        @wraps(func)
+        def cache_wrapper(__self__, *args, **kwargs) -> _RT:
+            marshalled_self = marshall_self(__self__, marshall_lock)
+            key = make_key(marshalled_self, args, kwargs)
+            lock, cache, counters, cache_get, cache_move_to_end, inflight, owner_keys = shards[
+                key.hashvalue & shard_mask
+            ]
+
+            with lock:
+                result = cache_get(key, _sentinel)
+                if result is not _sentinel:
+                    cache_move_to_end(key)
+                    counters[0] += 1
+                    return result
+                counters[1] += 1
+                event = leading_event = None
+                inflight_entry = inflight.get(key)
+                if inflight_entry is None:
+                    # this call leads the computation for the key,
+                    # concurrent misses below will wait on the event
+                    leading_event = Event()
+                    inflight[key] = (get_ident(), leading_event)
+                elif inflight_entry[0] != get_ident():
+                    event = inflight_entry[1]
+                # else: reentrant call from the thread already
+                # computing this key, waiting on itself would
+                # deadlock so fall through and recompute instead
+
+            if event is not None:
+                # another call is already computing this key, wait for
+                # it to publish instead of invoking `func` a second time
+                event.wait()
+                with lock:
+                    result = cache_get(key, _sentinel)
+                    if result is not _sentinel:
+                        return result
+                # the leading call raised (or its entry was already
+                # evicted), fall back to computing the value ourselves
+
+            try:
+                result = func(__self__, *args, **kwargs)
+                with lock:
+                    if key not in cache:
+                        cache[key] = result
+                        owner_keys.setdefault(key[0], set()).add(key)
+                        if len(cache) > shard_maxsize:
+                            # pop the oldest entry which sits at the
+                            # front and unindex it from its owner, the
+                            # popped value stays bound to a local so
+                            # its last reference drops after the lock
+                            oldkey, evicted_value = cache.popitem(last=False)
+                            old_owner = owner_keys.get(oldkey[0])
+                            if old_owner is not None:
+                                old_owner.discard(oldkey)
+                                if not old_owner:
+                                    del owner_keys[oldkey[0]]
+            finally:
+                if leading_event is not None:
+                    with lock:
+                        inflight.pop(key, None)
+                    # wake waiters even on failure so they can recompute
+                    leading_event.set()
+            return result
 
     def cache_info() -> _CacheInfo:
         """returns the cache info"""
-        with lock:
-            return _CacheInfo(misses=misses, hits=hits, maxsize=maxsize, full=full)
+        hits = misses = size = 0
+        for lock, cache, counters, *_ in shards:
+            with lock:
+                hits += counters[0]
+                misses += counters[1]
+                size += len(cache)
+        return _CacheInfo(
+            misses=misses,
+            hits=hits,
+            maxsize=maxsize,
+            full=maxsize is not None and size >= shard_maxsize * shard_count,
+        )
 
     def cache_clear() -> None:
         """clears the cache"""
-        nonlocal misses, hits
-        with lock:
-            cache.clear()
-            misses = 0
-            hits = 0
+        # cleared entries are kept alive here until every lock is
+        # released, dropping the last reference to a cached value can
+        # run a dead instance's finalizer which evicts through the
+        # same shard locks
+        graveyard = []
+        for lock, cache, counters, _, _, _, owner_keys in shards:
+            with lock:
+                graveyard.append((dict(cache), dict(owner_keys)))
+                cache.clear()
+                owner_keys.clear()
+                counters[0] = counters[1] = 0
+        del graveyard
+
+    def cache_clear_instance(__self__) -> None:
+        """clears only the cached entries of the given instance"""
+        _evict_marshalled(marshall_self(__self__, marshall_lock))
 
     cache_wrapper.cache_info = cache_info
     cache_wrapper.cache_clear = cache_clear
+    cache_wrapper.cache_clear_instance = cache_clear_instance
     return cache_wrapper
 
 
-def lru_cachemethod(maxsize: int = _LRU_DEFAULT_MAXSIZE):
+def lru_cachemethod(maxsize: int | None = _LRU_DEFAULT_MAXSIZE):
     def _lru_cachemethod_deco(func: Callable[..., _RT]) -> Callable[..., _RT]:
         return _lru_cachemthod_wrapper(func, maxsize=maxsize, base=_base_seed)
 
     return _lru_cachemethod_deco
 
 
-def weakref_lru_cachemethod(maxsize: int = _LRU_DEFAULT_MAXSIZE):
+def weakref_lru_cachemethod(maxsize: int | None = _LRU_DEFAULT_MAXSIZE):
     def _lru_cachemethod_deco(func: Callable[..., _RT]) -> Callable[..., _RT]:
         return _lru_cachemthod_wrapper(func, maxsize=maxsize, base=_base_weakref)
 